@@ -0,0 +1,123 @@
+"""Локальная замена mcc-codes.ru и merchantpoint.ru для нагрузочного теста.
+
+Отдает HTML из test/fixtures с настраиваемыми задержкой, долей ошибок
+и числом страниц выдачи. Запуск:
+
+    python test/fake_upstream.py --port 8081 --latency 150 --error-rate 0.01
+
+и затем приложение с переменными окружения:
+
+    MCC_CODES_URL=http://127.0.0.1:8081/search
+    MCC_DESCRIPTION_URL=http://127.0.0.1:8081/mcc/{mcc_code}
+"""
+import argparse
+import os
+import random
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+MCC_POOL = ["5411", "5499", "5812", "5814", "5912", "5311", "5691", "5732", "4121", "5541"]
+
+def load_fixture(name):
+    with open(os.path.join(FIXTURES_DIR, name), "r", encoding="utf-8") as f:
+        return f.read()
+
+class FakeUpstreamHandler(BaseHTTPRequestHandler):
+    # Параметры задаются в make_server
+    latency = 0.0
+    jitter = 0.0
+    error_rate = 0.0
+    pages = 3
+    rows_per_page = 20
+
+    page_template = load_fixture("mcc_codes_page.html")
+    row_template = load_fixture("mcc_codes_row.html")
+    empty_page = load_fixture("mcc_codes_empty.html")
+    description_template = load_fixture("mcc_description.html")
+
+    def do_GET(self):
+        # Имитируем сетевую задержку и сбои источника
+        time.sleep(max(0.0, self.latency + random.uniform(-self.jitter, self.jitter)))
+        if random.random() < self.error_rate:
+            self.send_html(503, "<h1>Service Unavailable</h1>")
+            return
+
+        url = urlparse(self.path)
+        if url.path.rstrip("/") == "/search":
+            params = parse_qs(url.query)
+            self.send_html(200, self.search_page(params.get("q", [""])[0], int(params.get("page", ["1"])[0])))
+        elif url.path.startswith("/mcc/"):
+            mcc = url.path.rsplit("/", 1)[-1]
+            self.send_html(200, self.description_template.format(mcc=mcc, description=f"Описание кода {mcc}"))
+        else:
+            self.send_html(404, "<h1>Not Found</h1>")
+
+    def search_page(self, query, page):
+        """Страница выдачи: одинаковый запрос всегда дает одинаковые строки."""
+        if page > self.pages:
+            return self.empty_page
+
+        rng = random.Random(zlib.crc32(f"{query}|{page}".encode("utf-8")))
+        rows = []
+        for number in range(self.rows_per_page):
+            rows.append(self.row_template.format(
+                store_name=f"{query} #{page}-{number}",
+                address=f"г. Москва, ул. Тестовая, д. {number + 1}",
+                mcc=rng.choice(MCC_POOL),
+                confirmations=rng.randint(0, 30),
+            ))
+        return self.page_template.format(rows="".join(rows))
+
+    def send_html(self, status, body):
+        data = body.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+def make_server(host="127.0.0.1", port=0, latency=0.1, jitter=0.0, error_rate=0.0, pages=3, rows_per_page=20):
+    """Создает сервер-заглушку; port=0 выбирает свободный порт."""
+    handler = type("ConfiguredHandler", (FakeUpstreamHandler,), {
+        "latency": latency,
+        "jitter": jitter,
+        "error_rate": error_rate,
+        "pages": pages,
+        "rows_per_page": rows_per_page,
+    })
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+def start_in_background(**kwargs):
+    """Запускает сервер в фоновом потоке и возвращает (сервер, базовый URL)."""
+    server = make_server(**kwargs)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    host, port = server.server_address[:2]
+    return server, f"http://{host}:{port}"
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency", type=float, default=150, help="задержка ответа, мс")
+    parser.add_argument("--jitter", type=float, default=50, help="разброс задержки, мс")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="доля ответов 503")
+    parser.add_argument("--pages", type=int, default=3, help="число страниц выдачи")
+    parser.add_argument("--rows-per-page", type=int, default=20)
+    args = parser.parse_args()
+
+    server = make_server(args.host, args.port, args.latency / 1000, args.jitter / 1000,
+                         args.error_rate, args.pages, args.rows_per_page)
+    print(f"Заглушка источников запущена на http://{args.host}:{args.port}")
+    server.serve_forever()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,178 @@
+"""Нагрузочный тест маршрутов поиска и избранного на локальной заглушке источников.
+
+Поднимает test/fake_upstream.py, направляет на него приложение через
+MCC_CODES_URL и MCC_DESCRIPTION_URL, создает пользователей во временной
+базе и гоняет их сессии через настоящее Flask-приложение в нескольких потоках.
+В конце печатает пропускную способность и p50/p95/p99 по каждому маршруту.
+
+    python test/load_test.py --users 20 --iterations 10 --latency 150
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+
+import numpy as np
+
+from fake_upstream import start_in_background
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=10, help="число одновременных сессий")
+    parser.add_argument("--iterations", type=int, default=5, help="сценариев на пользователя")
+    parser.add_argument("--queries", type=int, default=20, help="число разных поисковых запросов")
+    parser.add_argument("--latency", type=float, default=150, help="задержка источника, мс")
+    parser.add_argument("--jitter", type=float, default=50, help="разброс задержки, мс")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="доля ответов 503 от источника")
+    parser.add_argument("--pages", type=int, default=3, help="страниц выдачи на запрос")
+    parser.add_argument("--rows-per-page", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=1)
+    return parser.parse_args()
+
+def setup_app(upstream_url, database_path, relax_login_limits=True):
+    """Настраивает окружение до импорта приложения и возвращает модуль webapp.
+
+    По умолчанию снимает лимиты попыток входа и очереди хеширования: все
+    сессии теста приходят с одного адреса и входят одновременно.
+    """
+    os.environ["MCC_CODES_URL"] = f"{upstream_url}/search"
+    os.environ["MCC_DESCRIPTION_URL"] = upstream_url + "/mcc/{mcc_code}"
+    os.environ["DATABASE_URL"] = f"sqlite:///{database_path}"
+
+    # webapp читает справочники по относительному пути
+    os.chdir(ROOT_DIR)
+    sys.path.insert(0, ROOT_DIR)
+    import webapp
+
+    # Фоновое обновление избранного исказило бы замеры
+    webapp.app.config['PREFETCH_ENABLED'] = False
+    if relax_login_limits:
+        webapp.app.config['LOGIN_ATTEMPTS_PER_USERNAME'] = 10 ** 9
+        webapp.app.config['LOGIN_ATTEMPTS_PER_IP'] = 10 ** 9
+        webapp.app.config['PASSWORD_HASH_MAX_PENDING'] = 10 ** 6
+    with webapp.app.app_context():
+        webapp.db.create_all()
+    return webapp
+
+class Recorder:
+    """Собирает длительности запросов по маршрутам."""
+
+    def __init__(self):
+        self.timings = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.statuses = defaultdict(lambda: defaultdict(int))
+        self.failed_logins = 0
+        self._lock = threading.Lock()
+
+    def request(self, client, method, route, url, **kwargs):
+        started = time.perf_counter()
+        response = getattr(client, method)(url, **kwargs)
+        elapsed = time.perf_counter() - started
+        with self._lock:
+            self.timings[route].append(elapsed)
+            self.statuses[route][response.status_code] += 1
+            if response.status_code >= 500:
+                self.errors[route] += 1
+        return response
+
+def run_session(webapp, recorder, username, queries, iterations, rng):
+    """Сценарий пользователя: вход, поиск, выбор точки, избранное, категории."""
+    client = webapp.app.test_client()
+    response = recorder.request(client, "post", "POST /login", "/login",
+                                data={"username": username, "password": "password"})
+    if response.status_code != 302:
+        # Без входа все остальные запросы были бы быстрыми перенаправлениями на /login
+        with recorder._lock:
+            recorder.failed_logins += 1
+        return
+
+    for _ in range(iterations):
+        recorder.request(client, "get", "GET /search", "/search")
+
+        query = rng.choice(queries)
+        response = recorder.request(client, "post", "POST /search", "/search", data={"query": query})
+        location = response.headers.get("Location")
+        if not location:
+            continue
+
+        recorder.request(client, "get", "GET /search/<result_id>", location)
+        result_id = location.rstrip("/").rsplit("/", 1)[-1]
+        recorder.request(client, "post", "POST /select_store", "/select_store",
+                         data={"key": f"{result_id}:0"})
+
+        recorder.request(client, "post", "POST /add_to_favorites", "/add_to_favorites",
+                         data={"store_name": query, "mcc": "5411"})
+        recorder.request(client, "post", "POST /select_favorite", "/select_favorite",
+                         data={"store_name": query, "mcc": "5411"})
+        recorder.request(client, "get", "GET /view_categories", "/view_categories")
+
+def prepare_users(webapp, usernames):
+    """Создает пользователей с категориями кешбэка из примера в репозитории."""
+    with open(os.path.join(ROOT_DIR, "cashback_categories.json"), "r", encoding="utf-8") as f:
+        categories = json.dumps(json.load(f))
+    password = webapp.generate_password_hash("password")
+    with webapp.app.app_context():
+        for username in usernames:
+            webapp.db.session.add(webapp.User(username=username, password=password, cashback_categories=categories))
+        webapp.db.session.commit()
+
+def report(recorder, elapsed):
+    total = sum(len(timings) for timings in recorder.timings.values())
+    print(f"\nВсего запросов: {total} за {elapsed:.2f} с, {total / elapsed:.1f} запр/с\n")
+    print(f"{'Маршрут':<28}{'число':>7}{'ошибки':>8}{'запр/с':>9}{'p50, мс':>10}{'p95, мс':>10}{'p99, мс':>10}"
+          f"  статусы")
+    for route, timings in sorted(recorder.timings.items()):
+        p50, p95, p99 = np.percentile(np.array(timings) * 1000, [50, 95, 99])
+        statuses = " ".join(f"{status}:{number}" for status, number in sorted(recorder.statuses[route].items()))
+        print(f"{route:<28}{len(timings):>7}{recorder.errors[route]:>8}{len(timings) / elapsed:>9.1f}"
+              f"{p50:>10.1f}{p95:>10.1f}{p99:>10.1f}  {statuses}")
+
+    if recorder.failed_logins:
+        print(f"\nВНИМАНИЕ: {recorder.failed_logins} сессий не смогли войти и не выполняли сценарий")
+
+def main():
+    args = parse_args()
+    upstream, upstream_url = start_in_background(
+        latency=args.latency / 1000,
+        jitter=args.jitter / 1000,
+        error_rate=args.error_rate,
+        pages=args.pages,
+        rows_per_page=args.rows_per_page,
+    )
+
+    with tempfile.TemporaryDirectory() as tmp:
+        webapp = setup_app(upstream_url, os.path.join(tmp, "load_test.db"))
+        recorder = Recorder()
+        queries = [f"Магазин {number}" for number in range(args.queries)]
+        usernames = [f"load_user_{number}" for number in range(args.users)]
+
+        prepare_users(webapp, usernames)
+
+        threads = []
+        started = time.perf_counter()
+        for number, username in enumerate(usernames):
+            rng = random.Random(args.seed + number)
+            thread = threading.Thread(
+                target=run_session,
+                args=(webapp, recorder, username, queries, args.iterations, rng),
+            )
+            threads.append(thread)
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+
+        report(recorder, elapsed)
+        with webapp.app.app_context():
+            webapp.db.engine.dispose()
+    upstream.shutdown()
+
+if __name__ == "__main__":
+    main()
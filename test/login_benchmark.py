@@ -0,0 +1,120 @@
+"""Бенчмарк входа: пропускная способность /login и задержка поиска во время волны входов.
+
+Сначала измеряет задержку поиска без нагрузки, затем одновременно с поиском
+запускает потоки, непрерывно отправляющие /login (верные и неверные пароли
+с разных IP). Сравнить с хешированием в потоке запроса можно флагом --inline.
+
+    python test/login_benchmark.py --duration 10 --storm-threads 16
+"""
+import argparse
+import os
+import tempfile
+import threading
+import time
+from itertools import count
+
+import numpy as np
+
+from fake_upstream import start_in_background
+from load_test import Recorder, prepare_users, setup_app
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--duration", type=float, default=10, help="длительность каждой фазы, с")
+    parser.add_argument("--search-threads", type=int, default=4, help="потоков, выполняющих поиск")
+    parser.add_argument("--storm-threads", type=int, default=16, help="потоков, отправляющих /login")
+    parser.add_argument("--storm-users", type=int, default=50, help="число учетных записей для входа")
+    parser.add_argument("--latency", type=float, default=20, help="задержка источника, мс")
+    parser.add_argument("--inline", action="store_true", help="хешировать пароли в потоке запроса")
+    parser.add_argument("--no-limits", action="store_true", help="отключить лимиты попыток входа")
+    return parser.parse_args()
+
+def search_loop(webapp, recorder, username, stop, queries):
+    """Логинится и выполняет поиск новых запросов, пока не остановят."""
+    client = webapp.app.test_client()
+    response = client.post("/login", data={"username": username, "password": "password"})
+    if response.status_code != 302:
+        raise RuntimeError(f"Пользователь {username} не смог войти: {response.status_code}")
+    while not stop.is_set():
+        response = recorder.request(client, "post", "POST /search", "/search", data={"query": f"Точка {next(queries)}"})
+        location = response.headers.get("Location")
+        if location:
+            recorder.request(client, "get", "GET /search/<result_id>", location)
+        recorder.request(client, "get", "GET /view_categories", "/view_categories")
+
+def login_storm(webapp, recorder, number, usernames, stop):
+    """Непрерывно отправляет /login; каждый поток представляется отдельным IP."""
+    client = webapp.app.test_client()
+    environ = {"REMOTE_ADDR": f"10.0.{number // 256}.{number % 256}"}
+    attempt = 0
+    while not stop.is_set():
+        username = usernames[attempt % len(usernames)]
+        password = "password" if attempt % 2 else "wrong-password"
+        recorder.request(client, "post", "POST /login", "/login",
+                         data={"username": username, "password": password}, environ_base=environ)
+        attempt += 1
+
+def run_phase(webapp, args, search_users, storm_users, storm, queries):
+    recorder = Recorder()
+    stop = threading.Event()
+    threads = [
+        threading.Thread(target=search_loop, args=(webapp, recorder, username, stop, queries))
+        for username in search_users
+    ]
+    if storm:
+        threads += [
+            threading.Thread(target=login_storm, args=(webapp, recorder, number, storm_users, stop))
+            for number in range(args.storm_threads)
+        ]
+
+    for thread in threads:
+        thread.start()
+    time.sleep(args.duration)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    return recorder
+
+def summarize(title, recorder, duration):
+    print(f"\n{title}")
+    for route, timings in sorted(recorder.timings.items()):
+        p50, p95, p99 = np.percentile(np.array(timings) * 1000, [50, 95, 99])
+        print(f"  {route:<26}{len(timings) / duration:>8.1f} запр/с"
+              f"   p50 {p50:>7.1f}   p95 {p95:>7.1f}   p99 {p99:>7.1f} мс")
+
+def main():
+    args = parse_args()
+    upstream, upstream_url = start_in_background(latency=args.latency / 1000, pages=2)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        webapp = setup_app(upstream_url, os.path.join(tmp, "login_benchmark.db"), relax_login_limits=False)
+        if args.inline:
+            webapp.app.config['PASSWORD_HASH_WORKERS'] = 0
+        if args.no_limits:
+            webapp.app.config['LOGIN_ATTEMPTS_PER_USERNAME'] = webapp.app.config['LOGIN_ATTEMPTS_PER_IP'] = 10 ** 9
+
+        search_users = [f"search_user_{number}" for number in range(args.search_threads)]
+        storm_users = [f"storm_user_{number}" for number in range(args.storm_users)]
+        prepare_users(webapp, search_users + storm_users)
+        queries = count()
+
+        quiet = run_phase(webapp, args, search_users, storm_users, False, queries)
+        summarize("Без нагрузки на вход:", quiet, args.duration)
+
+        stormy = run_phase(webapp, args, search_users, storm_users, True, queries)
+        summarize("Во время волны входов:", stormy, args.duration)
+
+        # 302 — успешный вход, 200 — неверный пароль, 429 — отклонено лимитом до хеширования,
+        # 503 — очередь хеширования заполнена
+        statuses = stormy.statuses['POST /login']
+        hashed = statuses[302] + statuses[200]
+        print(f"\nВходов с проверкой пароля: {hashed / args.duration:.1f} в секунду "
+              f"(успешных {statuses[302]}, неверный пароль {statuses[200]}); "
+              f"отклонено лимитом: {statuses[429]}, очередь заполнена: {statuses[503]}")
+
+        with webapp.app.app_context():
+            webapp.db.engine.dispose()
+    upstream.shutdown()
+
+if __name__ == "__main__":
+    main()
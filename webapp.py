@@ -1,17 +1,50 @@
-from flask import Flask, render_template, request, jsonify, redirect, url_for, flash, session
+from flask import Flask, render_template, request, jsonify, redirect, url_for, flash, session, make_response
 from flask_sqlalchemy import SQLAlchemy
+import asyncio
 import json
+import hashlib
 import requests
 from bs4 import BeautifulSoup
 from werkzeug.security import generate_password_hash, check_password_hash
 from datetime import timedelta
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
+import os
+import secrets
+import threading
+import time
 import pandas as pd
+import numpy as np
 import re
 
 app = Flask(__name__)
 app.secret_key = 'your_secret_key'
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///site.db'
+app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', 'sqlite:///site.db')
 app.config['PERMANENT_SESSION_LIFETIME'] = timedelta(days=30)  # Срок действия сессии
+app.config['MAX_CONTENT_LENGTH'] = 50 * 1024 * 1024  # Максимальный размер загружаемой выписки
+app.config['STATEMENT_DEBITS_NEGATIVE'] = True  # В выписке списания записаны отрицательными суммами
+app.config['SEARCH_RESULTS_MAX_ENTRIES'] = 1000  # Сколько результатов поиска держать в памяти
+app.config['SEARCH_RESULTS_TTL'] = timedelta(hours=24)  # Срок хранения результатов поиска
+app.config['MCC_DESCRIPTION_TTL'] = timedelta(days=7)  # Срок хранения описаний MCC-кодов
+app.config['PREFETCH_ENABLED'] = True  # Фоновое обновление данных для избранных точек
+app.config['PREFETCH_HOURS'] = (2, 6)  # Часы низкой нагрузки: с 02:00 до 06:00
+app.config['PREFETCH_INTERVAL'] = timedelta(minutes=10)  # Как часто проверять, нужно ли обновление
+app.config['PREFETCH_MAX_AGE'] = timedelta(hours=12)  # Данные старше этого срока обновляются
+app.config['PREFETCH_BUDGET'] = 50  # Сколько точек обновлять за один проход
+app.config['PREFETCH_TIME_BUDGET'] = timedelta(minutes=15)  # Максимальная длительность прохода
+app.config['PAGE_CACHE_CONTROL'] = 'private, no-cache'  # Браузер кэширует страницы, но проверяет ETag
+# Источники данных о торговых точках (для нагрузочного теста указывается локальный сервер)
+app.config['MCC_CODES_URL'] = os.environ.get('MCC_CODES_URL', 'https://mcc-codes.ru/search')
+app.config['MCC_DESCRIPTION_URL'] = os.environ.get('MCC_DESCRIPTION_URL', 'https://merchantpoint.ru/mcc/{mcc_code}')
+app.config['UPSTREAM_TIMEOUT'] = 10  # Таймаут запросов к источникам данных, с
+app.config['PASSWORD_HASH_METHOD'] = 'scrypt:32768:8:1'  # Стоимость хеширования; при изменении пароли перехешируются при входе
+app.config['PASSWORD_HASH_WORKERS'] = 2  # Процессов для хеширования паролей (0 — в потоке запроса)
+app.config['PASSWORD_HASH_MAX_PENDING'] = 8  # Сколько хеширований может ждать свободного процесса
+app.config['LOGIN_ATTEMPT_WINDOW'] = timedelta(minutes=5)  # Окно подсчета попыток входа
+app.config['LOGIN_ATTEMPTS_PER_USERNAME'] = 10  # Попыток входа на одно имя пользователя за окно
+app.config['LOGIN_ATTEMPTS_PER_IP'] = 30  # Попыток входа и регистрации с одного IP за окно
 db = SQLAlchemy(app)
 
 # Модель пользователя
@@ -20,6 +53,11 @@ class User(db.Model):
     username = db.Column(db.String(80), unique=True, nullable=False)
     password = db.Column(db.String(120), nullable=False)
     cashback_categories = db.Column(db.String, nullable=True)
+    data_version = db.Column(db.Integer, nullable=False, default=0, server_default='0')  # Растет при изменении данных
+
+    def touch(self):
+        """Отмечает изменение категорий или избранного пользователя."""
+        self.data_version = (self.data_version or 0) + 1
 
 # Модель для избранных торговых точек
 class FavoriteStore(db.Model):
@@ -32,9 +70,37 @@ class FavoriteStore(db.Model):
     def __repr__(self):
         return f"FavoriteStore('{self.store_name}', '{self.mcc}')"
 
+# Модель для истории поиска: копия выбранной точки на случай, если результаты поиска вытеснены из памяти
+class SearchHistoryEntry(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    key = db.Column(db.String(40), nullable=False)  # "<result_id>:<номер>", как в сессии
+    search_query = db.Column(db.String(200), nullable=True)  # Исходный запрос пользователя
+    store_name = db.Column(db.String(200), nullable=False)
+    mcc = db.Column(db.String(10), nullable=False)
+    description = db.Column(db.String, nullable=True)
+
+def upgrade_schema():
+    """Добавляет в существующую базу колонки, появившиеся в новых версиях."""
+    table = User.__table__.name
+    columns = {column['name'] for column in db.inspect(db.engine).get_columns(table)}
+    if 'data_version' not in columns:
+        # "user" — зарезервированное слово, например, в PostgreSQL, поэтому имя экранируем
+        quoted = db.engine.dialect.identifier_preparer.quote(table)
+        with db.engine.begin() as connection:
+            connection.execute(db.text(f'ALTER TABLE {quoted} ADD COLUMN data_version INTEGER NOT NULL DEFAULT 0'))
+
+# Создаем таблицы и обновляем схему при запуске процесса: и под flask run, и под WSGI-сервером
+with app.app_context():
+    db.create_all()
+    upgrade_schema()
+
 # Загрузка данных
-with open("all_mcc_categories.json", "r", encoding="utf-8") as f:
-    all_mcc_categories = json.load(f)
+with open("all_mcc_categories.json", "rb") as f:
+    all_mcc_categories_raw = f.read()
+all_mcc_categories = json.loads(all_mcc_categories_raw)
+# Версия справочника категорий входит в ETag страниц
+CATEGORY_DATA_VERSION = hashlib.sha1(all_mcc_categories_raw).hexdigest()[:12]
 
 def parse_range(mcc):
     """Парсит MCC-коды, включая диапазоны."""
@@ -87,36 +153,119 @@ def find_best_cashback(all_mcc_categories, user_cashback_categories, mcc):
 
     return best_bank, best_category, max_cashback
 
+# Таблица поиска по MCC: коды 0000–9999 и отдельная ячейка для нераспознанных кодов
+MCC_TABLE_SIZE = 10001
+UNKNOWN_MCC_SLOT = MCC_TABLE_SIZE - 1
+
+def build_category_mcc_index(all_mcc_categories):
+    """Строит для каждой категории массив покрываемых MCC-кодов."""
+    index = {}
+    all_codes = np.arange(MCC_TABLE_SIZE)
+    for bank, categories in all_mcc_categories.items():
+        for category, mcc_list in categories.items():
+            if "*" in mcc_list:
+                # Универсальная категория покрывает все коды, включая нераспознанные
+                index[(bank, category)] = all_codes
+                continue
+            codes = set()
+            for code in mcc_list:
+                codes.update(parse_range(code))
+            index[(bank, category)] = np.array(sorted(c for c in codes if 0 <= c < UNKNOWN_MCC_SLOT), dtype=np.int64)
+    return index
+
+category_mcc_index = build_category_mcc_index(all_mcc_categories)
+
+def build_category_coverage(category_mcc_index):
+    """Упаковывает покрытие категорий в битовые множества по всем MCC-кодам."""
+    keys = list(category_mcc_index.keys())
+    coverage = np.zeros((len(keys), MCC_TABLE_SIZE), dtype=bool)
+    for row, key in enumerate(keys):
+        coverage[row, category_mcc_index[key]] = True
+    return {key: row for row, key in enumerate(keys)}, np.packbits(coverage, axis=1)
+
+category_coverage_rows, category_coverage_bits = build_category_coverage(category_mcc_index)
+
+def build_cashback_lookup(category_mcc_index, user_cashback_categories):
+    """Вычисляет лучший кешбэк сразу для всех MCC-кодов.
+
+    Возвращает массив процентов, массив номеров победивших категорий (-1, если
+    кешбэка нет) и список пар (банк, категория). Результат совпадает с
+    find_best_cashback: при равном проценте остается первая найденная категория.
+    """
+    rates = np.zeros(MCC_TABLE_SIZE)
+    winners = np.full(MCC_TABLE_SIZE, -1, dtype=np.int64)
+    labels = []
+
+    for bank, user_categories in user_cashback_categories.items():
+        for category, cashback in user_categories.items():
+            codes = category_mcc_index.get((bank, category))
+            if codes is None:
+                continue
+
+            # Обновляем только коды, где новая категория строго выгоднее
+            codes = codes[rates[codes] < cashback]
+            rates[codes] = cashback
+            winners[codes] = len(labels)
+            labels.append((bank, category))
+
+    return rates, winners, labels
+
+REQUEST_HEADERS = {"User-Agent": "Mozilla/5.0"}
+# Сколько страниц поиска асинхронный вариант запрашивает наперед
+ASYNC_PAGE_WINDOW = 2
+
+def mcc_codes_params(store_name, page):
+    return {"q": store_name, "extended": 0, "sortBy": "date", "sortDir": "desc", "page": page}
+
+def parse_mcc_codes_page(html):
+    """Извлекает заголовки и строки таблицы со страницы поиска (None, если таблицы нет)."""
+    soup = BeautifulSoup(html, "html.parser")
+    table = soup.find("table", class_="table")
+
+    if not table:
+        return None
+
+    table_headers = [th.text.strip() for th in table.find_all("th")]
+    rows = table.find_all("tr")[1:]  # Пропускаем заголовок таблицы
+    return table_headers, [[col.text.strip() for col in row.find_all("td")] for row in rows]
+
+def parse_mcc_description(html):
+    """Извлекает описание MCC-кода из заголовка страницы."""
+    soup = BeautifulSoup(html, "html.parser")
+    title_tag = soup.find("h1")
+
+    if title_tag:
+        # Извлекаем описание из заголовка
+        return title_tag.text.strip().split("-", 1)[-1].strip()
+    return None
+
 def get_mcc_codes(store_name):
-    base_url = "https://mcc-codes.ru/search"
-    headers = {"User-Agent": "Mozilla/5.0"}
     all_data = []
     page = 1
     data_found = False  # Флаг для проверки наличия данных
 
     while True:
-        params = {"q": store_name, "extended": 0, "sortBy": "date", "sortDir": "desc", "page": page}
-        response = requests.get(base_url, params=params, headers=headers)
+        try:
+            response = requests.get(app.config['MCC_CODES_URL'], params=mcc_codes_params(store_name, page),
+                                    headers=REQUEST_HEADERS, timeout=app.config['UPSTREAM_TIMEOUT'])
+        except requests.exceptions.RequestException as e:
+            print("Ошибка запроса:", e)
+            return None
 
         if response.status_code != 200:
             print("Ошибка запроса:", response.status_code)
             return None
         
-        soup = BeautifulSoup(response.text, "html.parser")
-        table = soup.find("table", class_="table")
+        parsed = parse_mcc_codes_page(response.text)
         
-        if not table:
+        if not parsed:
             if not data_found:
                 print("Таблица не найдена. Возможно, данных для данного запроса нет.")
             break
         
         data_found = True  # Данные найдены хотя бы на одной странице
-        table_headers = [th.text.strip() for th in table.find_all("th")]
-        rows = table.find_all("tr")[1:]  # Пропускаем заголовок таблицы
-        
-        for row in rows:
-            cols = row.find_all("td")
-            all_data.append([col.text.strip() for col in cols])
+        table_headers, rows = parsed
+        all_data.extend(rows)
         
         page += 1  # Переход к следующей странице
     
@@ -126,33 +275,43 @@ def get_mcc_codes(store_name):
     df = pd.DataFrame(all_data, columns=table_headers)
     return df
 
+# Кэш описаний MCC-кодов: mcc -> (время загрузки, описание)
+mcc_description_cache = {}
+
+def cached_mcc_description(mcc_code):
+    """Возвращает описание из кэша, если оно еще не устарело."""
+    cached = mcc_description_cache.get(str(mcc_code))
+    if cached and time.monotonic() - cached[0] < app.config['MCC_DESCRIPTION_TTL'].total_seconds():
+        return cached[1]
+    return None
+
+def remember_mcc_description(mcc_code, html):
+    """Разбирает страницу описания MCC-кода и сохраняет результат в кэш."""
+    description = parse_mcc_description(html)
+    if not description:
+        return "Описание не найдено"
+
+    mcc_description_cache[str(mcc_code)] = (time.monotonic(), description)
+    return description
+
 def get_mcc_description(mcc_code):
     """Получает описание MCC-кода с сайта merchantpoint.ru."""
-    url = f"https://merchantpoint.ru/mcc/{mcc_code}"
-    headers = {"User-Agent": "Mozilla/5.0"}
-    
+    description = cached_mcc_description(mcc_code)
+    if description:
+        return description
+
     try:
-        response = requests.get(url, headers=headers)
+        response = requests.get(app.config['MCC_DESCRIPTION_URL'].format(mcc_code=mcc_code), headers=REQUEST_HEADERS,
+                                timeout=app.config['UPSTREAM_TIMEOUT'])
         response.raise_for_status()  # Проверяем, что запрос успешен
     except requests.exceptions.RequestException as e:
         print(f"Ошибка при запросе описания для MCC {mcc_code}: {e}")
         return "Описание не найдено"
     
-    soup = BeautifulSoup(response.text, "html.parser")
-    title_tag = soup.find("h1")
-    
-    if title_tag:
-        # Извлекаем описание из заголовка
-        description = title_tag.text.strip().split("-", 1)[-1].strip()
-        return description
-    else:
-        return "Описание не найдено"
+    return remember_mcc_description(mcc_code, response.text)
 
-def get_mcc_data(store_name):
-    df = get_mcc_codes(store_name)
-    if df is None:
-        return pd.DataFrame(columns=["Название точки", "mcc", "Описание"])
-    
+def summarize_mcc_codes(df):
+    """Сводит строки поиска по MCC-кодам, отсортированные по числу повторений."""
     # Извлекаем название точки и число подтверждений
     def extract_store_name(value):
         parts = value.split("\n")
@@ -178,15 +337,758 @@ def get_mcc_data(store_name):
     result = mcc_counts.merge(max_confirmations, left_on="mcc", right_on="MCC")
     result = result.drop(columns=["MCC"])  # Убираем дублирующий столбец
     
+    # Сортируем по убыванию числа повторений
+    return result.sort_values(by="Число повторений", ascending=False)
+
+def get_mcc_data(store_name):
+    df = get_mcc_codes(store_name)
+    if df is None:
+        return pd.DataFrame(columns=["Название точки", "mcc", "Описание"])
+    
+    result = summarize_mcc_codes(df)
+    
     # Добавляем описание MCC-кода
     result["Описание"] = result["mcc"].apply(get_mcc_description)
     
-    # Сортируем по убыванию числа повторений
-    result = result.sort_values(by="Число повторений", ascending=False)
-    
     # Возвращаем DataFrame с нужными колонками
     return result[["Название точки", "mcc", "Описание"]]
 
+# Асинхронный вариант поиска для async-представлений Flask
+async def fetch_url(url, params=None):
+    """Выполняет запрос в пуле потоков, не блокируя цикл событий."""
+    return await asyncio.to_thread(requests.get, url, params=params, headers=REQUEST_HEADERS,
+                                   timeout=app.config['UPSTREAM_TIMEOUT'])
+
+async def get_mcc_description_async(mcc_code):
+    """Асинхронно получает описание MCC-кода с сайта merchantpoint.ru."""
+    description = cached_mcc_description(mcc_code)
+    if description:
+        return description
+
+    try:
+        response = await fetch_url(app.config['MCC_DESCRIPTION_URL'].format(mcc_code=mcc_code))
+        response.raise_for_status()  # Проверяем, что запрос успешен
+    except requests.exceptions.RequestException as e:
+        print(f"Ошибка при запросе описания для MCC {mcc_code}: {e}")
+        return "Описание не найдено"
+
+    return remember_mcc_description(mcc_code, response.text)
+
+async def get_mcc_data_async(store_name):
+    """Асинхронный вариант get_mcc_data.
+
+    Следующие страницы поиска запрашиваются наперед, пока страницы приходят
+    полными, а описания MCC-кодов загружаются сразу, как только код
+    встретился на странице, поэтому обе фазы идут одновременно в одном
+    цикле событий.
+    """
+    empty = pd.DataFrame(columns=["Название точки", "mcc", "Описание"])
+    pages = {}
+    descriptions = {}
+    all_data = []
+    table_headers = None
+    full_page = None  # Число строк на полной странице
+    full_pages = 0  # Сколько страниц подряд пришли полными
+    page = 1
+
+    try:
+        while True:
+            # Наперед запрашиваем только после двух полных страниц подряд:
+            # по одной странице не понять, полная она или последняя, а за
+            # неполной страницей выдача заканчивается и лишний запрос не нужен
+            window = ASYNC_PAGE_WINDOW if full_pages > 1 else 1
+            for ahead in range(page, page + window):
+                if ahead not in pages:
+                    pages[ahead] = asyncio.create_task(fetch_url(app.config['MCC_CODES_URL'], mcc_codes_params(store_name, ahead)))
+
+            try:
+                response = await pages.pop(page)
+            except requests.exceptions.RequestException as e:
+                print("Ошибка запроса:", e)
+                return empty
+            if response.status_code != 200:
+                print("Ошибка запроса:", response.status_code)
+                return empty
+
+            parsed = parse_mcc_codes_page(response.text)
+            if not parsed:
+                if table_headers is None:
+                    print("Таблица не найдена. Возможно, данных для данного запроса нет.")
+                break
+
+            table_headers, rows = parsed
+            all_data.extend(rows)
+
+            # Описания новых MCC-кодов загружаем, не дожидаясь остальных страниц
+            mcc_column = table_headers.index("MCC")
+            for row in rows:
+                mcc = row[mcc_column]
+                if mcc not in descriptions:
+                    descriptions[mcc] = asyncio.create_task(get_mcc_description_async(mcc))
+
+            if full_page is None:
+                full_page = len(rows)
+            elif len(rows) < full_page:
+                break  # Неполная страница — последняя
+            full_pages += 1
+
+            page += 1  # Переход к следующей странице
+
+        if not all_data:
+            return empty
+
+        result = summarize_mcc_codes(pd.DataFrame(all_data, columns=table_headers))
+        found = dict(zip(descriptions, await asyncio.gather(*descriptions.values())))
+        result["Описание"] = result["mcc"].map(found)
+        return result[["Название точки", "mcc", "Описание"]]
+    finally:
+        # Отменяем ожидание лишних запросов; уже запущенный в потоке запрос
+        # отменить нельзя, поэтому окно наперед открывается только после
+        # полных страниц
+        for task in list(pages.values()) + list(descriptions.values()):
+            task.cancel()
+
+# Импорт банковских выписок
+STATEMENT_CHUNK_SIZE = 50000
+STATEMENT_SAMPLE_SIZE = 64 * 1024  # Сколько байт читать для определения кодировки
+STATEMENT_COLUMNS = {
+    "date": ("date", "дата", "дата операции", "дата платежа"),
+    "amount": ("amount", "сумма", "сумма операции", "сумма платежа"),
+    "mcc": ("mcc", "mcc-код", "код mcc"),
+}
+
+def detect_statement_format(file):
+    """Определяет кодировку, разделитель и нужные колонки по началу выписки."""
+    # Заголовок может быть на латинице, поэтому кодировку определяем по первым строкам
+    sample = file.read(STATEMENT_SAMPLE_SIZE)
+    file.seek(0)
+
+    try:
+        encoding = "utf-8-sig"
+        sample.decode(encoding)
+    except UnicodeDecodeError as e:
+        # Ошибка в последних байтах — это обрезанный на границе выборки символ UTF-8
+        if e.reason != "unexpected end of data":
+            encoding = "cp1251"
+
+    header = sample.split(b"\n", 1)[0].decode(encoding, errors="replace")
+
+    sep = ";" if header.count(";") > header.count(",") else ","
+    names = [name.strip().strip('"').strip() for name in header.strip().split(sep)]
+
+    columns = {}
+    for key, aliases in STATEMENT_COLUMNS.items():
+        for name in names:
+            if name.lower() in aliases:
+                columns[key] = name
+                break
+        else:
+            return None
+
+    return encoding, sep, columns
+
+def parse_statement_dates(values):
+    """Парсит даты выписки: ISO-формат (2024-01-31) или день первым (31.01.2024)."""
+    first = values.dropna().head(1)
+    dayfirst = first.empty or not re.match(r"\d{4}-", first.iloc[0])
+    return pd.to_datetime(values, dayfirst=dayfirst, errors="coerce")
+
+def read_statement_chunks(file, chunksize=STATEMENT_CHUNK_SIZE):
+    """Читает выписку по частям и возвращает очищенные фрагменты (month, amount, mcc)."""
+    statement_format = detect_statement_format(file)
+    if statement_format is None:
+        raise ValueError("В выписке должны быть колонки с датой, суммой и MCC-кодом")
+    encoding, sep, columns = statement_format
+    debit_sign = -1 if app.config['STATEMENT_DEBITS_NEGATIVE'] else 1
+
+    reader = pd.read_csv(
+        file,
+        sep=sep,
+        encoding=encoding,
+        usecols=list(columns.values()),
+        dtype=str,
+        chunksize=chunksize,
+    )
+    for chunk in reader:
+        # Суммы могут быть записаны как "1 234,56"
+        amount = chunk[columns["amount"]].str.replace(r"[\s\xa0]", "", regex=True).str.replace(",", ".")
+        frame = pd.DataFrame({
+            "month": parse_statement_dates(chunk[columns["date"]]).dt.to_period("M"),
+            "amount": pd.to_numeric(amount, errors="coerce") * debit_sign,
+            "mcc": pd.to_numeric(chunk[columns["mcc"]], errors="coerce"),
+        })
+        # Оставляем только списания: возвраты и поступления не дают кешбэка
+        frame = frame.dropna()
+        yield frame[frame["amount"] > 0]
+
+def process_statement(file, user_cashback_categories, statement_bank=None, chunksize=STATEMENT_CHUNK_SIZE):
+    """Считает полученный и возможный кешбэк по выписке.
+
+    Полученный кешбэк считается по категориям банка statement_bank, возможный —
+    по лучшей карте пользователя для каждого MCC-кода.
+    """
+    rates, winners, labels = build_cashback_lookup(category_mcc_index, user_cashback_categories)
+    if statement_bank in user_cashback_categories:
+        earned_rates, _, _ = build_cashback_lookup(
+            category_mcc_index, {statement_bank: user_cashback_categories[statement_bank]}
+        )
+    else:
+        earned_rates = np.zeros(MCC_TABLE_SIZE)
+
+    partials = []
+    rows = 0
+    for frame in read_statement_chunks(file, chunksize):
+        mcc = frame["mcc"].to_numpy(dtype=np.int64)
+        slots = np.where((mcc >= 0) & (mcc < UNKNOWN_MCC_SLOT), mcc, UNKNOWN_MCC_SLOT)
+        amount = frame["amount"].to_numpy()
+
+        frame = pd.DataFrame({
+            "month": frame["month"].to_numpy(),
+            "winner": winners[slots],
+            "amount": amount,
+            "earned": amount * earned_rates[slots] / 100,
+            "potential": amount * rates[slots] / 100,
+        })
+        partials.append(frame.groupby(["month", "winner"], sort=False).sum())
+        rows += len(frame)
+
+    if not rows:
+        return None
+
+    totals = pd.concat(partials).groupby(level=["month", "winner"]).sum().reset_index()
+    totals["month"] = totals["month"].astype(str)
+    labels = labels + [("Без кешбэка", "")]
+    totals["bank"] = [labels[winner][0] for winner in totals["winner"]]
+    totals["category"] = [labels[winner][1] for winner in totals["winner"]]
+    totals = totals.round({"amount": 2, "earned": 2, "potential": 2})
+
+    by_month = totals.groupby("month")[["amount", "earned", "potential"]].sum().reset_index()
+    by_category = (
+        totals.groupby(["bank", "category"])[["amount", "potential"]].sum()
+        .reset_index()
+        .sort_values(by="potential", ascending=False)
+    )
+
+    return {
+        "rows": rows,
+        "amount": round(totals["amount"].sum(), 2),
+        "earned": round(totals["earned"].sum(), 2),
+        "potential": round(totals["potential"].sum(), 2),
+        "by_month": by_month.round(2).to_dict('records'),
+        "by_category": by_category.round(2).to_dict('records'),
+        "details": (
+            totals.sort_values(by=["month", "potential"], ascending=[True, False])
+            [["month", "bank", "category", "amount", "earned", "potential"]]
+            .to_dict('records')
+        ),
+    }
+
+# Подбор категорий на месяц
+# Сколько категорий банк разрешает выбрать (можно изменить в форме)
+CATEGORY_CHOICE_LIMITS = {"Сбер": 3, "Альфа": 3, "Т-Банк": 4}
+OPTIMIZER_NODE_LIMIT = 5000
+
+def statement_spending_by_mcc(file, chunksize=STATEMENT_CHUNK_SIZE):
+    """Суммирует траты из выписки по MCC-кодам."""
+    partials = [frame.groupby("mcc")["amount"].sum() for frame in read_statement_chunks(file, chunksize)]
+    if not partials:
+        return {}
+    spending = pd.concat(partials).groupby(level=0).sum()
+    return {int(mcc): float(amount) for mcc, amount in spending.items()}
+
+def optimize_category_selection(spending, offers, limits, fixed=None, node_limit=OPTIMIZER_NODE_LIMIT):
+    """Подбирает категории для активации, максимизирующие ожидаемый кешбэк.
+
+    spending — траты по MCC-кодам, offers — предложенные банками категории
+    с процентами, limits — сколько категорий можно выбрать в каждом банке,
+    fixed — уже действующие категории других карт. Перебор идет методом ветвей
+    и границ от жадного решения; при превышении node_limit возвращается лучшее
+    найденное решение. Возвращает выбранные категории по банкам и ожидаемый кешбэк.
+    """
+    mcc = np.array(list(spending.keys()), dtype=np.int64)
+    weights = np.array(list(spending.values()), dtype=float) / 100
+    slots = np.where((mcc >= 0) & (mcc < UNKNOWN_MCC_SLOT), mcc, UNKNOWN_MCC_SLOT)
+
+    def coverage(keys):
+        rows = [category_coverage_rows[key] for key in keys]
+        bits = np.unpackbits(category_coverage_bits[rows], axis=1, count=MCC_TABLE_SIZE)
+        return bits[:, slots].astype(bool)
+
+    # Лучший процент по каждому MCC от уже действующих категорий
+    base = np.zeros(len(mcc))
+    fixed_keys = [(bank, category) for bank, categories in (fixed or {}).items()
+                  for category in categories if (bank, category) in category_coverage_rows]
+    if fixed_keys:
+        fixed_rates = np.array([fixed[bank][category] for bank, category in fixed_keys], dtype=float)
+        base = (coverage(fixed_keys) * fixed_rates[:, None]).max(axis=0).clip(min=0)
+
+    keys = [(bank, category) for bank, categories in offers.items()
+            for category, rate in categories.items()
+            if rate > 0 and (bank, category) in category_coverage_rows]
+    if not keys or not len(mcc):
+        return {}, round(float(weights @ base), 2)
+
+    rates = np.array([offers[bank][category] for bank, category in keys], dtype=float)
+    covered = coverage(keys)
+
+    def gains(current, candidates):
+        """Прирост кешбэка от добавления каждой из категорий к текущему выбору."""
+        uplift = np.maximum(rates[candidates, None] - current[None, :], 0) * covered[candidates]
+        return uplift @ weights
+
+    # Кандидаты без пользы отбрасываем, остальные перебираем от самых выгодных
+    standalone = gains(base, np.arange(len(keys)))
+    order = [i for i in np.argsort(-standalone, kind="stable") if standalone[i] > 0]
+    banks = [keys[i][0] for i in order]
+    capacity = {bank: limits.get(bank, len(offers[bank])) for bank in offers}
+
+    def upper_bound(current, position, counts):
+        """Оценка сверху: сумма лучших приростов в пределах оставшихся лимитов."""
+        candidates = order[position:]
+        if not candidates:
+            return 0.0
+        remaining = {bank: capacity[bank] - counts.get(bank, 0) for bank in capacity}
+        bound = 0.0
+        for candidate, gain in sorted(zip(candidates, gains(current, candidates)), key=lambda item: -item[1]):
+            bank = keys[candidate][0]
+            if remaining[bank] > 0:
+                remaining[bank] -= 1
+                bound += gain
+        return bound
+
+    # Жадное решение — стартовая нижняя граница
+    current, chosen, counts = base.copy(), [], {}
+    while True:
+        available = [i for i in order if i not in chosen and counts.get(keys[i][0], 0) < capacity[keys[i][0]]]
+        if not available:
+            break
+        available_gains = gains(current, available)
+        best = int(np.argmax(available_gains))
+        if available_gains[best] <= 0:
+            break
+        candidate = available[best]
+        chosen.append(candidate)
+        counts[keys[candidate][0]] = counts.get(keys[candidate][0], 0) + 1
+        current = np.maximum(current, rates[candidate] * covered[candidate])
+
+    best_value = float(weights @ current)
+    best_choice = list(chosen)
+    nodes = 0
+
+    def search(position, current, value, chosen, counts):
+        nonlocal best_value, best_choice, nodes
+        if value > best_value + 1e-9:
+            best_value, best_choice = value, list(chosen)
+        if position == len(order) or nodes >= node_limit:
+            return
+        nodes += 1
+        if value + upper_bound(current, position, counts) <= best_value + 1e-9:
+            return
+
+        candidate, bank = order[position], banks[position]
+        if counts.get(bank, 0) < capacity[bank]:
+            extended = np.maximum(current, rates[candidate] * covered[candidate])
+            counts[bank] = counts.get(bank, 0) + 1
+            chosen.append(candidate)
+            search(position + 1, extended, float(weights @ extended), chosen, counts)
+            chosen.pop()
+            counts[bank] -= 1
+        search(position + 1, current, value, chosen, counts)
+
+    search(0, base, float(weights @ base), [], {})
+
+    selection = {}
+    for candidate in sorted(best_choice):
+        bank, category = keys[candidate]
+        selection.setdefault(bank, []).append(category)
+    return selection, round(best_value, 2)
+
+# Кэш результатов поиска
+class SearchResultStore:
+    """Хранит результаты поиска в памяти сервера с вытеснением по LRU и TTL.
+
+    В сессии пользователя остаются только короткие идентификаторы результатов.
+    """
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl.total_seconds()
+        self._entries = OrderedDict()  # result_id -> (срок действия, запрос, торговые точки)
+        self._queries = {}  # нормализованный запрос -> result_id
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _normalize(query):
+        return " ".join(query.lower().split())
+
+    def _drop(self, result_id):
+        _, query, _ = self._entries.pop(result_id)
+        if self._queries.get(self._normalize(query)) == result_id:
+            del self._queries[self._normalize(query)]
+
+    def put(self, query, stores):
+        """Сохраняет результаты поиска и возвращает их идентификатор."""
+        with self._lock:
+            result_id = secrets.token_urlsafe(6)
+            while result_id in self._entries:
+                result_id = secrets.token_urlsafe(6)
+
+            self._entries[result_id] = (time.monotonic() + self.ttl, query, stores)
+            self._queries[self._normalize(query)] = result_id
+            while len(self._entries) > self.max_entries:
+                self._drop(next(iter(self._entries)))
+            return result_id
+
+    def get(self, result_id, touch=True):
+        """Возвращает (запрос, торговые точки) или None, если результат устарел.
+
+        При touch=False чтение не меняет позицию результата в очереди LRU.
+        """
+        with self._lock:
+            entry = self._entries.get(result_id)
+            if entry is None:
+                return None
+            expires, query, stores = entry
+            if expires < time.monotonic():
+                self._drop(result_id)
+                return None
+            if touch:
+                self._entries.move_to_end(result_id)
+            return query, stores
+
+    def age(self, query):
+        """Возвращает возраст последнего результата по запросу в секундах или None."""
+        result_id = self.find(query, touch=False)
+        if result_id is None:
+            return None
+        with self._lock:
+            entry = self._entries.get(result_id)
+        if entry is None:
+            return None
+        return time.monotonic() - (entry[0] - self.ttl)
+
+    def find(self, query, touch=True):
+        """Возвращает идентификатор недавнего поиска с тем же запросом."""
+        with self._lock:
+            result_id = self._queries.get(self._normalize(query))
+        if result_id is not None and self.get(result_id, touch) is not None:
+            return result_id
+        return None
+
+search_results = SearchResultStore(app.config['SEARCH_RESULTS_MAX_ENTRIES'], app.config['SEARCH_RESULTS_TTL'])
+
+# Фоновое обновление данных для избранных точек
+class PrefetchScheduler(threading.Thread):
+    """Поддерживает в кэше результаты поиска для самых популярных избранных точек.
+
+    В часы низкой нагрузки заново получает MCC-коды и описания для точек,
+    которые чаще всего добавляют в избранное, чтобы запросы пользователей
+    попадали в уже прогретый кэш.
+    """
+
+    def __init__(self, app):
+        super().__init__(name="prefetch-scheduler", daemon=True)
+        self.app = app
+        self._stop_event = threading.Event()
+        self.status = {"last_run": None, "refreshed": 0, "failed": 0}
+        self.ranking = []  # Популярные точки по данным последнего прохода
+
+    def stop(self):
+        self._stop_event.set()
+
+    def is_off_peak(self):
+        start, end = self.app.config['PREFETCH_HOURS']
+        hour = time.localtime().tm_hour
+        return start <= hour < end if start <= end else hour >= start or hour < end
+
+    def popular_store_names(self):
+        """Возвращает названия избранных точек по убыванию числа пользователей."""
+        with self.app.app_context():
+            rows = (
+                db.session.query(FavoriteStore.store_name, FavoriteStore.user_id)
+                .distinct()
+                .all()
+            )
+
+        # Одну точку у разных пользователей обновляем один раз
+        users = {}
+        names = {}
+        for store_name, user_id in rows:
+            key = SearchResultStore._normalize(store_name)
+            users.setdefault(key, set()).add(user_id)
+            names.setdefault(key, store_name.strip())
+        return [names[key] for key in sorted(users, key=lambda key: -len(users[key]))]
+
+    def run_once(self):
+        """Обновляет устаревшие данные в пределах бюджета, возвращает число обновленных точек."""
+        config = self.app.config
+        deadline = time.monotonic() + config['PREFETCH_TIME_BUDGET'].total_seconds()
+        max_age = config['PREFETCH_MAX_AGE'].total_seconds()
+        refreshed = failed = 0
+
+        self.ranking = self.popular_store_names()
+        for store_name in self.ranking:
+            if refreshed + failed >= config['PREFETCH_BUDGET'] or time.monotonic() >= deadline:
+                break
+            if self._stop_event.is_set():
+                break
+
+            age = search_results.age(store_name)
+            if age is not None and age < max_age:
+                continue
+
+            mcc_data = get_mcc_data(store_name)
+            if mcc_data is None or mcc_data.empty:
+                failed += 1
+                continue
+            search_results.put(store_name, mcc_data.to_dict('records'))
+            refreshed += 1
+
+        self.status.update(
+            last_run=time.strftime("%Y-%m-%d %H:%M:%S"),
+            refreshed=refreshed,
+            failed=failed,
+        )
+        return refreshed
+
+    def freshness(self, limit=None):
+        """Возвращает сводку о свежести данных для популярных точек без их названий.
+
+        Используется рейтинг последнего прохода, чтобы запрос статуса не сканировал избранное.
+        """
+        max_age = self.app.config['PREFETCH_MAX_AGE'].total_seconds()
+        ages = [search_results.age(store_name) for store_name in self.ranking[:limit]]
+        cached = [age for age in ages if age is not None]
+        return {
+            "tracked": len(ages),
+            "fresh": sum(age < max_age for age in cached),
+            "stale": sum(age >= max_age for age in cached),
+            "missing": len(ages) - len(cached),
+            "oldest_age_seconds": int(max(cached)) if cached else None,
+        }
+
+    def run(self):
+        interval = self.app.config['PREFETCH_INTERVAL'].total_seconds()
+        while not self._stop_event.is_set():
+            if self.is_off_peak():
+                try:
+                    self.run_once()
+                except Exception as e:
+                    print(f"Ошибка фонового обновления: {e}")
+            self._stop_event.wait(interval)
+
+prefetch_scheduler = PrefetchScheduler(app)
+prefetch_start_lock = threading.Lock()
+
+@app.before_request
+def start_prefetch_scheduler():
+    """Запускает планировщик в процессе, который обслуживает запросы (один раз)."""
+    if not app.config['PREFETCH_ENABLED'] or prefetch_scheduler.ident is not None:
+        return
+    with prefetch_start_lock:
+        if prefetch_scheduler.ident is None:
+            prefetch_scheduler.start()
+
+def resolve_history_item(key):
+    """Находит торговую точку из истории по ключу вида "<result_id>:<номер>"."""
+    if not isinstance(key, str) or ":" not in key:
+        return None
+    result_id, number = key.rsplit(":", 1)
+    result = search_results.get(result_id)
+    if result is None or not number.isdigit() or int(number) >= len(result[1]):
+        return None
+    query, stores = result
+    return query, stores[int(number)]
+
+def search_history(user_id):
+    """Возвращает историю поиска по ключам из сессии.
+
+    Данные точки берутся из результатов в памяти, а если они уже вытеснены —
+    из сохраненной в базе копии. result_id указан, только пока сами
+    результаты еще доступны.
+    """
+    keys = [key for key in session.get('search_history', []) if isinstance(key, str)]
+    if not keys:
+        return []
+
+    saved = {
+        entry.key: entry
+        for entry in SearchHistoryEntry.query.filter(
+            SearchHistoryEntry.user_id == user_id, SearchHistoryEntry.key.in_(keys)
+        )
+    }
+    history = []
+    for key in keys:
+        item = resolve_history_item(key)
+        if item is not None:
+            query, store = item
+            history.append({
+                'key': key,
+                'query': query,
+                'store_name': store['Название точки'],
+                'mcc': store['mcc'],
+                'description': store['Описание'],
+                'result_id': key.rsplit(":", 1)[0],
+            })
+        elif key in saved:
+            entry = saved[key]
+            history.append({
+                'key': key,
+                'query': entry.search_query,
+                'store_name': entry.store_name,
+                'mcc': entry.mcc,
+                'description': entry.description,
+                'result_id': None,
+            })
+    return history
+
+# Условное кэширование страниц (ETag / 304)
+def user_data_version(username):
+    """Возвращает (id, версия данных) пользователя без загрузки самих данных."""
+    return db.session.query(User.id, User.data_version).filter_by(username=username).first()
+
+def templates_version():
+    """Хеш всех шаблонов: после выкладки новой разметки старые ETag перестают совпадать."""
+    folder = os.path.join(app.root_path, app.template_folder)
+    digest = hashlib.sha1()
+    for name in sorted(os.listdir(folder)):
+        with open(os.path.join(folder, name), "rb") as f:
+            digest.update(name.encode("utf-8") + f.read())
+    return digest.hexdigest()[:12]
+
+TEMPLATES_VERSION = templates_version()
+
+def page_etag(version, *parts):
+    """ETag страницы из версии данных пользователя, версий приложения, шаблонов, справочника и параметров страницы."""
+    raw = "|".join(str(part) for part in (
+        version.id, version.data_version, APP_VERSION, TEMPLATES_VERSION, CATEGORY_DATA_VERSION
+    ) + parts)
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()[:16]
+
+def not_modified(etag):
+    """Возвращает ответ 304, если у клиента актуальная версия страницы."""
+    if not request.if_none_match.contains_weak(etag):
+        return None
+    response = app.response_class(status=304)
+    response.set_etag(etag, weak=True)
+    response.headers['Cache-Control'] = app.config['PAGE_CACHE_CONTROL']
+    return response
+
+def with_etag(body, etag):
+    """Добавляет к странице ETag и заголовок Cache-Control."""
+    response = make_response(body)
+    response.set_etag(etag, weak=True)
+    response.headers['Cache-Control'] = app.config['PAGE_CACHE_CONTROL']
+    return response
+
+# Хеширование паролей и ограничение попыток входа
+class PasswordHasherBusy(Exception):
+    """Очередь хеширования паролей заполнена или пул процессов упал."""
+
+class PasswordHasher:
+    """Выполняет хеширование паролей в ограниченном пуле процессов.
+
+    Вычисление KDF не занимает GIL рабочего потока, а при переполнении
+    очереди запрос сразу отклоняется.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self._executor = None
+        self._slots = None
+        self._reference = None  # (метод из настроек, его запись в хеше)
+        self._lock = threading.Lock()
+
+    def _run(self, function, *args):
+        workers = self.app.config['PASSWORD_HASH_WORKERS']
+        if not workers:
+            return function(*args)
+
+        with self._lock:
+            if self._executor is None:
+                # forkserver вместо fork: процессы не наследуют потоки и
+                # блокировки многопоточного сервера
+                self._executor = ProcessPoolExecutor(max_workers=workers,
+                                                     mp_context=multiprocessing.get_context("forkserver"))
+            if self._slots is None:
+                self._slots = threading.BoundedSemaphore(workers + self.app.config['PASSWORD_HASH_MAX_PENDING'])
+            executor, slots = self._executor, self._slots
+
+        if not slots.acquire(blocking=False):
+            raise PasswordHasherBusy()
+        try:
+            return executor.submit(function, *args).result()
+        except BrokenProcessPool:
+            # Рабочий процесс умер: сбрасываем пул, следующий вызов создаст новый
+            with self._lock:
+                if self._executor is executor:
+                    self._executor = None
+            executor.shutdown(wait=False)
+            raise PasswordHasherBusy()
+        finally:
+            slots.release()
+
+    def hash(self, password):
+        return self._run(generate_password_hash, password, self.app.config['PASSWORD_HASH_METHOD'])
+
+    def verify(self, password_hash, password):
+        return self._run(check_password_hash, password_hash, password)
+
+    def needs_rehash(self, password_hash):
+        """Проверяет, создан ли хеш с другими параметрами стоимости."""
+        return password_hash.split("$", 1)[0] != self.method_prefix()
+
+    def method_prefix(self):
+        """Полная запись метода в хеше: Werkzeug дополняет короткие имена ('scrypt',
+        'pbkdf2:sha256') параметрами по умолчанию, поэтому берем ее из эталонного хеша."""
+        method = self.app.config['PASSWORD_HASH_METHOD']
+        with self._lock:
+            if self._reference is None or self._reference[0] != method:
+                self._reference = (method, generate_password_hash("", method).split("$", 1)[0])
+            return self._reference[1]
+
+password_hasher = PasswordHasher(app)
+
+class AttemptLimiter:
+    """Считает попытки по ключу (имя пользователя, IP) в скользящем окне."""
+
+    def __init__(self, window):
+        self.window = window.total_seconds()
+        self._attempts = {}  # ключ -> время попыток
+        self._next_prune = time.monotonic() + self.window
+        self._lock = threading.Lock()
+
+    def allow(self, key, limit):
+        """Регистрирует попытку и возвращает False, если лимит за окно исчерпан."""
+        now = time.monotonic()
+        with self._lock:
+            attempts = self._attempts.setdefault(key, deque())
+            while attempts and attempts[0] <= now - self.window:
+                attempts.popleft()
+            if len(attempts) >= limit:
+                return False
+            attempts.append(now)
+
+            # Раз в окно убираем ключи без свежих попыток
+            if now >= self._next_prune:
+                self._attempts = {k: v for k, v in self._attempts.items() if v and v[-1] > now - self.window}
+                self._next_prune = now + self.window
+            return True
+
+    def reset(self, key):
+        with self._lock:
+            self._attempts.pop(key, None)
+
+login_limiter = AttemptLimiter(app.config['LOGIN_ATTEMPT_WINDOW'])
+
+def login_attempt_allowed(username=None):
+    """Проверяет лимиты попыток до любого хеширования пароля."""
+    if not login_limiter.allow(f"ip:{request.remote_addr}", app.config['LOGIN_ATTEMPTS_PER_IP']):
+        return False
+    if username is not None:
+        return login_limiter.allow(f"user:{username}", app.config['LOGIN_ATTEMPTS_PER_USERNAME'])
+    return True
+
 # Версия RADAR Cashback
 APP_VERSION = "1.0.8"
 
@@ -203,8 +1105,26 @@ def login():
         password = request.form['password']
         remember = request.form.get('remember')  # Проверяем, выбран ли флажок "Запомнить меня"
 
+        if not login_attempt_allowed(username):
+            flash('Слишком много попыток входа. Попробуйте позже.')
+            return render_template('login.html'), 429
+
         user = User.query.filter_by(username=username).first()
-        if user and check_password_hash(user.password, password):
+        try:
+            valid = user is not None and password_hasher.verify(user.password, password)
+        except PasswordHasherBusy:
+            flash('Сервер перегружен. Попробуйте войти позже.')
+            return render_template('login.html'), 503
+
+        if valid:
+            # Пароль, захешированный со старыми параметрами, перехешируем
+            if password_hasher.needs_rehash(user.password):
+                try:
+                    user.password = password_hasher.hash(password)
+                    db.session.commit()
+                except PasswordHasherBusy:
+                    pass  # Перехешируем при следующем входе
+            login_limiter.reset(f"user:{username}")
             session['username'] = username
             if remember:  # Если флажок "Запомнить меня" выбран
                 session.permanent = True  # Делаем сессию постоянной
@@ -218,7 +1138,16 @@ def register():
     if request.method == 'POST':
         username = request.form['username']
         password = request.form['password']
-        hashed_password = generate_password_hash(password)
+
+        if not login_attempt_allowed():
+            flash('Слишком много попыток. Попробуйте позже.')
+            return render_template('register.html'), 429
+
+        try:
+            hashed_password = password_hasher.hash(password)
+        except PasswordHasherBusy:
+            flash('Сервер перегружен. Попробуйте позже.')
+            return render_template('register.html'), 503
         new_user = User(username=username, password=hashed_password)
         db.session.add(new_user)
         db.session.commit()
@@ -232,64 +1161,101 @@ def logout():
     return redirect(url_for('index'))
 
 @app.route('/search', methods=['GET', 'POST'])
-def search():
+async def search():
     if 'username' not in session:
         return redirect(url_for('login'))
 
+    if request.method == 'GET':
+        # История поиска хранится в сессии, поэтому тоже входит в ETag
+        version = user_data_version(session['username'])
+        # Сначала разбираем историю: от доступности результатов зависит разметка
+        history = search_history(version.id)
+        etag = page_etag(version, 'search', *((item['key'], item['result_id']) for item in history))
+        response = not_modified(etag)
+        if response:
+            return response
+
+        favorites = FavoriteStore.query.filter_by(user_id=version.id).all()
+        return with_etag(render_template('search.html', favorites=favorites, history=history), etag)
+
     user = User.query.filter_by(username=session['username']).first()
     favorites = FavoriteStore.query.filter_by(user_id=user.id).all()
 
-    if request.method == 'GET':
-        return render_template('search.html', favorites=favorites)
-
     query = request.form.get('query')
     if not query:
-        return render_template('search.html', error="Введите название торговой точки", favorites=favorites)
+        return render_template('search.html', error="Введите название торговой точки", favorites=favorites,
+                               history=search_history(user.id))
+
+    # Повторный поиск того же запроса отдаем из памяти
+    result_id = search_results.find(query)
+    if result_id is None:
+        # Получаем данные о торговых точках: страницы и описания загружаются параллельно
+        mcc_data = await get_mcc_data_async(query)
+
+        if mcc_data is None or mcc_data.empty:
+            return render_template('search.html', error="Торговые точки не найдены", favorites=favorites,
+                                   history=search_history(user.id))
 
-    # Получаем данные о торговых точках
-    mcc_data = get_mcc_data(query)
+        # Преобразуем DataFrame в список словарей и сохраняем на сервере
+        result_id = search_results.put(query, mcc_data.to_dict('records'))
 
-    if mcc_data is None or mcc_data.empty:
-        return render_template('search.html', error="Торговые точки не найдены")
+    # Перенаправляем, чтобы кнопка "Назад" открывала результаты без повторного поиска
+    return redirect(url_for('show_search_results', result_id=result_id))
+
+@app.route('/search/<result_id>')
+def show_search_results(result_id):
+    if 'username' not in session:
+        return redirect(url_for('login'))
 
-    # Преобразуем DataFrame в список словарей для передачи в шаблон
-    stores = mcc_data.to_dict('records')
+    result = search_results.get(result_id)
+    if result is None:
+        flash('Результаты поиска устарели, повторите поиск')
+        return redirect(url_for('search'))
 
-    # Передаем название торговой точки в шаблон
-    return render_template('select_store.html', stores=stores, query=query)  # Добавляем query
+    query, stores = result
+    return render_template('select_store.html', stores=stores, query=query, result_id=result_id)
 
 @app.route('/select_store', methods=['POST'])
 def select_store():
     if 'username' not in session:
         return redirect(url_for('login'))
 
-    selected_mcc = request.form.get('mcc')
-    store_name = request.form.get('store_name')
-    query = request.form.get('query')  # Получаем исходный запрос пользователя
+    user = User.query.filter_by(username=session['username']).first()
 
-    if not selected_mcc or not store_name:
+    # Точка выбирается по ключу "<result_id>:<номер>" из сохраненных результатов поиска
+    key = request.form.get('key')
+    item = resolve_history_item(key)
+    saved = SearchHistoryEntry.query.filter_by(user_id=user.id, key=key).first() if key else None
+    if item is not None:
+        query, store = item
+        if saved is None:
+            db.session.add(SearchHistoryEntry(
+                user_id=user.id,
+                key=key,
+                search_query=query,
+                store_name=store['Название точки'],
+                mcc=store['mcc'],
+                description=store['Описание'],
+            ))
+        selected_mcc = store['mcc']
+    elif saved is not None:
+        # Результаты уже вытеснены из памяти — берем копию из истории
+        query, selected_mcc = saved.search_query, saved.mcc
+    else:
+        flash('Результаты поиска устарели, повторите поиск')
         return redirect(url_for('search'))
 
-    # Сохраняем выбранный MCC и название точки в историю поиска
-    if 'search_history' not in session:
-        session['search_history'] = []
-    
-    # Добавляем новый запрос в историю (максимум 5 записей)
-    session['search_history'].insert(0, {
-        'store_name': store_name,  # Передаем название точки из формы
-        'mcc': selected_mcc,
-        'description': request.form.get('description')  # Передаем описание MCC из формы
-    })
-    
-    # Ограничиваем историю 5 последними запросами
-    if len(session['search_history']) > 5:
-        session['search_history'] = session['search_history'][:5]
-    
-    # Помечаем сессию как измененную
-    session.modified = True
+    # Добавляем выбор в историю поиска (максимум 5 записей, без повторов); в сессии только ключи
+    history = [k for k in session.get('search_history', []) if isinstance(k, str) and k != key]
+    session['search_history'] = [key] + history[:4]
+
+    # Копии записей, выпавших из истории, больше не нужны
+    SearchHistoryEntry.query.filter(
+        SearchHistoryEntry.user_id == user.id, SearchHistoryEntry.key.notin_(session['search_history'])
+    ).delete(synchronize_session=False)
+    db.session.commit()
 
     # Загружаем категории пользователя
-    user = User.query.filter_by(username=session['username']).first()
     user_cashback_categories = json.loads(user.cashback_categories) if user.cashback_categories else {}
 
     # Находим лучший банк и категорию
@@ -318,10 +1284,11 @@ def remove_from_history():
     if 'username' not in session:
         return redirect(url_for('login'))
 
-    index = int(request.form.get('index'))
-    if 'search_history' in session and 0 <= index < len(session['search_history']):
-        session['search_history'].pop(index)
-        session.modified = True  # Помечаем сессию как измененную
+    key = request.form.get('key')
+    session['search_history'] = [k for k in session.get('search_history', []) if isinstance(k, str) and k != key]
+    user = User.query.filter_by(username=session['username']).first()
+    SearchHistoryEntry.query.filter_by(user_id=user.id, key=key).delete()
+    db.session.commit()
 
     return redirect(url_for('search'))
 
@@ -388,6 +1355,7 @@ def add_to_favorites():
     new_favorite = FavoriteStore(user_id=user.id, store_name=store_name, mcc=mcc, order=max_order + 1)
 
     db.session.add(new_favorite)
+    user.touch()
     db.session.commit()
 
     flash('Торговая точка добавлена в избранное')
@@ -415,6 +1383,7 @@ def edit_favorite(favorite_id):
 
         favorite.store_name = store_name
         favorite.mcc = mcc
+        user.touch()
         db.session.commit()
 
         flash('Торговая точка успешно обновлена')
@@ -435,6 +1404,7 @@ def delete_favorite(favorite_id):
         return redirect(url_for('search'))
 
     db.session.delete(favorite)
+    user.touch()
     db.session.commit()
 
     flash('Торговая точка удалена из избранного')
@@ -455,19 +1425,112 @@ def update_favorites_order():
             favorite = FavoriteStore.query.filter_by(id=int(fav_id), user_id=user.id).first()
             if favorite:
                 favorite.order = index  # Обновляем порядок
+        user.touch()
         db.session.commit()
         return jsonify({"status": "success"})
     except Exception as e:
         return jsonify({"status": "error", "message": str(e)}), 500
 
+@app.route('/prefetch_status', methods=['GET'])
+def prefetch_status():
+    if 'username' not in session:
+        return jsonify({"status": "error", "message": "Unauthorized"}), 403
+
+    return jsonify({
+        "status": "success",
+        "running": prefetch_scheduler.is_alive(),
+        "last_run": prefetch_scheduler.status["last_run"],
+        "refreshed": prefetch_scheduler.status["refreshed"],
+        "failed": prefetch_scheduler.status["failed"],
+        "stores": prefetch_scheduler.freshness(app.config['PREFETCH_BUDGET']),  # Только счетчики, без названий точек
+    })
+
 @app.route('/view_categories', methods=['GET'])
 def view_categories():
     if 'username' not in session:
         return redirect(url_for('login'))
 
+    etag = page_etag(user_data_version(session['username']), 'view_categories')
+    response = not_modified(etag)
+    if response:
+        return response
+
     user = User.query.filter_by(username=session['username']).first()
     user_cashback_categories = json.loads(user.cashback_categories) if user.cashback_categories else {}
-    return render_template('view_categories.html', categories=user_cashback_categories)
+    return with_etag(render_template('view_categories.html', categories=user_cashback_categories), etag)
+
+@app.route('/import_statement', methods=['GET', 'POST'])
+def import_statement():
+    if 'username' not in session:
+        return redirect(url_for('login'))
+
+    user = User.query.filter_by(username=session['username']).first()
+    user_cashback_categories = json.loads(user.cashback_categories) if user.cashback_categories else {}
+    banks = list(user_cashback_categories.keys())
+
+    if request.method == 'GET':
+        return render_template('import_statement.html', banks=banks)
+
+    statement = request.files.get('statement')
+    if not statement or not statement.filename:
+        return render_template('import_statement.html', error="Выберите файл выписки.", banks=banks)
+
+    statement_bank = request.form.get('bank_name')
+    try:
+        report = process_statement(statement.stream, user_cashback_categories, statement_bank)
+    except (ValueError, pd.errors.ParserError) as e:
+        return render_template('import_statement.html', error=f"Не удалось разобрать выписку: {e}", banks=banks)
+
+    if report is None:
+        return render_template('import_statement.html', error="В выписке не найдено операций.", banks=banks)
+
+    return render_template('import_statement.html', banks=banks, selected_bank=statement_bank, report=report)
+
+@app.route('/optimize_categories', methods=['GET', 'POST'])
+def optimize_categories():
+    if 'username' not in session:
+        return redirect(url_for('login'))
+
+    user = User.query.filter_by(username=session['username']).first()
+    user_cashback_categories = json.loads(user.cashback_categories) if user.cashback_categories else {}
+
+    # Подбираем категории только для банков пользователя, где их выбирают каждый месяц
+    banks = [bank for bank in user_cashback_categories if bank in CATEGORY_CHOICE_LIMITS]
+    available_categories = {bank: list(all_mcc_categories.get(bank, {}).keys()) for bank in banks}
+    context = dict(banks=banks, available_categories=available_categories, limits=CATEGORY_CHOICE_LIMITS)
+
+    if request.method == 'GET':
+        return render_template('optimize_categories.html', **context)
+
+    statement = request.files.get('statement')
+    if not statement or not statement.filename:
+        return render_template('optimize_categories.html', error="Загрузите выписку с историей трат.", **context)
+
+    # Предложенные банком категории: поле rate-<банк>-<номер категории>
+    offers, limits = {}, {}
+    try:
+        for bank in banks:
+            limits[bank] = int(request.form.get(f'limit-{bank}') or CATEGORY_CHOICE_LIMITS[bank])
+            for number, category in enumerate(available_categories[bank]):
+                rate = request.form.get(f'rate-{bank}-{number}')
+                if rate:
+                    offers.setdefault(bank, {})[category] = float(rate)
+    except ValueError:
+        return render_template('optimize_categories.html', error="Лимит и кешбэк должны быть числами.", **context)
+
+    if not offers:
+        return render_template('optimize_categories.html', error="Укажите кешбэк хотя бы для одной предложенной категории.", **context)
+
+    try:
+        spending = statement_spending_by_mcc(statement.stream)
+    except (ValueError, pd.errors.ParserError) as e:
+        return render_template('optimize_categories.html', error=f"Не удалось разобрать выписку: {e}", **context)
+
+    # Категории остальных банков считаем уже действующими
+    fixed = {bank: categories for bank, categories in user_cashback_categories.items() if bank not in offers}
+    selection, cashback = optimize_category_selection(spending, offers, limits, fixed)
+
+    return render_template('optimize_categories.html', selection=selection, cashback=cashback, **context)
 
 @app.route('/add_bank', methods=['GET', 'POST'])
 def add_bank():
@@ -491,6 +1554,7 @@ def add_bank():
 
         user_cashback_categories[bank_name] = {}
         user.cashback_categories = json.dumps(user_cashback_categories)
+        user.touch()
         db.session.commit()
 
         return render_template('add_bank.html', success=f"Банк '{bank_name}' успешно добавлен.", banks=available_banks)
@@ -500,6 +1564,12 @@ def update_categories():
     if 'username' not in session:
         return redirect(url_for('login'))
 
+    if request.method == 'GET':
+        etag = page_etag(user_data_version(session['username']), 'update_categories', request.args.get('bank'))
+        response = not_modified(etag)
+        if response:
+            return response
+
     # Загрузка данных из базы
     user = User.query.filter_by(username=session['username']).first()
     user_cashback_categories = json.loads(user.cashback_categories) if user.cashback_categories else {}
@@ -515,13 +1585,13 @@ def update_categories():
         if selected_bank and selected_bank in all_mcc_categories:
             available_categories = list(all_mcc_categories[selected_bank].keys())
         
-        return render_template(
+        return with_etag(render_template(
             'update_categories.html',
             banks=banks,
             selected_bank=selected_bank,
             categories=categories,
             available_categories=available_categories
-        )
+        ), etag)
 
     # Если POST-запрос, обработаем действия пользователя
     elif request.method == 'POST':
@@ -534,6 +1604,7 @@ def update_categories():
             if category_to_delete and bank_name in user_cashback_categories:
                 user_cashback_categories[bank_name].pop(category_to_delete, None)
                 user.cashback_categories = json.dumps(user_cashback_categories)
+                user.touch()
                 db.session.commit()
                 flash(f"Категория '{category_to_delete}' удалена.")
 
@@ -546,6 +1617,7 @@ def update_categories():
                     cashback = float(cashback)
                     user_cashback_categories[bank_name][category] = cashback
                     user.cashback_categories = json.dumps(user_cashback_categories)
+                    user.touch()
                     db.session.commit()
                     flash(f"Категория '{category}' обновлена или добавлена.")
                 except ValueError:
@@ -576,6 +1648,7 @@ def delete_bank():
         if bank_name in user_cashback_categories:
             del user_cashback_categories[bank_name]
             user.cashback_categories = json.dumps(user_cashback_categories)
+            user.touch()
             db.session.commit()
             banks = list(user_cashback_categories.keys())
             return render_template('delete_bank.html', success=f"Банк '{bank_name}' успешно удалён.", banks=banks)
@@ -583,6 +1656,4 @@ def delete_bank():
             return render_template('delete_bank.html', error=f"Банк '{bank_name}' не найден.", banks=banks)
 
 if __name__ == '__main__':
-    with app.app_context():
-        db.create_all()
     app.run(host='0.0.0.0', port=5000, debug=True)